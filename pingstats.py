@@ -1,20 +1,52 @@
 import argparse
+import functools
+import io
+import itertools
 import json
+import pathlib
+import shutil
 import subprocess
 import sys
-import plotly.graph_objs as pogo
+
+# orjson is optional, the standard library serializer is used when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def save_cumulative_stats_json(output, path):
-    with open(path, "w") as json_write:
-        json.dump(output, json_write, indent=4)
+    if orjson:
+        with open(path, "wb") as json_write:
+            json_write.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
+        return
+
+    # Same 2 space indent and raw UTF-8 as orjson, so both paths write identical files
+    with open(path, "w", encoding="utf-8") as json_write:
+        json.dump(output, json_write, indent=2, ensure_ascii=False)
+
+
+# Writes the figure in the format given by the extension of path, HTML is serialized directly without starting Kaleido
+def write_figure(fig, path):
+    suffix = pathlib.Path(path).suffix.lower()
+    if suffix in ('.html', '.htm'):
+        fig.write_html(path, include_plotlyjs='cdn')
+    elif suffix == '.svg':
+        fig.write_image(path, format='svg')
+    else:
+        fig.write_image(path, format='pdf')
+
 
+# Save the ping latencies as a box plot in the format given by the -g extension (PDF by default)
 def save_latency_distribution_boxplot_pdf(output, args):
+    # Imported lazily as plotly is slow to load, --help and failed pings never pay for it
+    import plotly.graph_objs as pogo
+
     fig = pogo.Figure()
 
     fig.add_trace(
         pogo.Box(
-            y = [data[-1] for data in output.values()],
+            y = [data[-1] for data in output],
             name="Latencies",
             boxpoints='all',
             jitter=0.5,
@@ -27,23 +59,51 @@ def save_latency_distribution_boxplot_pdf(output, args):
         yaxis_title="Latency (ms)",
         showlegend=False
     )
-    fig.write_image(args.graph if args.graph else "./pingstats.pdf", format='pdf')
-
-
-def parse_ping_output(output, args):
-    ping_data = {}
-    i = 1
-    output = output.split("\n")
-    output = output[1: -5]
-    max_ping = args.max_pings if args.max_pings else len(output) - 1
-    for ping in output[1: max_ping + 1]:
-        parts = ping.split()
-        ping_data[f"{i}"] = [parts[3], parts[4], parts[-2].split("=")[-1]]
-        i += 1
+    write_figure(fig, args.graph if args.graph else "./pingstats.pdf")
+
+
+# Yields the lines of a stream while keeping a copy of them in output
+def record_lines(stream, output):
+    for line in stream:
+        output.append(line)
+        yield line
+
+
+def parse_ping_output(ping_lines, args):
+    max_pings = args.max_pings
+    ping_data = [None] * max_pings if max_pings else []
+    count = 0
+    split = str.split
+
+    # Streams the replies, skipping the ping header and the first reply and stopping at the blank line before the ping statistics
+    replies = itertools.takewhile(str.strip, itertools.islice(ping_lines, 2, None))
+    for ping in itertools.islice(replies, max_pings or None):
+        # Skips errors and timeouts (e.g. "Destination Host Unreachable", "Request timeout for icmp_seq 2")
+        _, separator, latency = ping.rpartition(" time=")
+        if not separator or " bytes from " not in ping:
+            continue
+
+        parts = split(ping, None, 5)
+        reply = (parts[3], parts[4], split(latency, None, 1)[0])
+        if max_pings:
+            ping_data[count] = reply
+        else:
+            ping_data.append(reply)
+        count += 1
+
+    # Trims the unused slots when ping returned fewer replies than requested
+    del ping_data[count:]
     return ping_data
 
+
+# Resolves a command to its absolute path once, falling back to the bare name so a missing command still fails on launch
+@functools.lru_cache(maxsize=None)
+def resolve_command(name):
+    return shutil.which(name) or name
+
+
 def execute_ping(args):
-    command = ['ping', args.target]
+    command = [resolve_command('ping'), args.target]
 
     if args.run_delay:
         command.extend(['-i', str(args.run_delay)])
@@ -51,17 +111,27 @@ def execute_ping(args):
     if args.max_pings:
         command.extend(['-c', str(args.max_pings)])
 
+    output = []
+
     try:
         '''
-        capture_output=True catches either result (output: stdout or error: stderr)
-        check=True raises a CalledProcessError if subsystem exit code was non-zero (indicates an error)
+        stdout=PIPE streams the output line by line (bufsize=1 line buffers it), so replies are parsed while ping is still running
+        stderr=PIPE catches the error output, which is only read once stdout is exhausted
+        close_fds=False with an absolute executable path lets subprocess start ping with posix_spawn instead of fork + exec
+        A CalledProcessError is raised if subsystem exit code was non-zero (indicates an error)
         text=True returns output as string instead of bytes
         '''
-        ping_output = subprocess.run(command, capture_output=True, text=True, check=True)
-        return ping_output.stdout
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1, close_fds=False) as ping_process:
+            parsed_output = parse_ping_output(record_lines(ping_process.stdout, output), args)
+            output.extend(ping_process.stdout) # Keeps the ping statistics for the JSON output
+            stderr = ping_process.stderr.read()
+
+        if ping_process.returncode != 0:
+            raise subprocess.CalledProcessError(ping_process.returncode, command, None, stderr)
+        return "".join(output), parsed_output
     except subprocess.CalledProcessError as e:
         print(f"Error executing ping {e}", file=sys.stderr)
-        return None
+        return None, []
 
 
 def use_test_directory(args):
@@ -76,16 +146,15 @@ def unwrap_arguments(argument_parser):
         args.max_pings = 30
 
     output = []
-    parsed_output = {}
+    parsed_output = []
     if args.test:
         output = use_test_directory(args)
-        parsed_output = parse_ping_output(output, args)
+        parsed_output = parse_ping_output(io.StringIO(output), args)
     else:
         if not args.target:
             argument_parser.error("A target '-t' is required if '--test' is absent)")
 
-        output = execute_ping(args)
-        parsed_output = parse_ping_output(output, args)
+        output, parsed_output = execute_ping(args)
 
     if output:
         save_cumulative_stats_json(output, args.output if args.output else "./pingstats.json")
@@ -103,7 +172,7 @@ def main():
                         help="Number of seconds to wait between two consecutive pings")
     argument_parser.add_argument('-m', '--max-pings', type=int, help="Number of max pings for ping")
     argument_parser.add_argument('-o', '--output', help="Path and name of output JSON file containing the stats")
-    argument_parser.add_argument('-g', '--graph', help="Path and name of output PDF file containing stats graph")
+    argument_parser.add_argument('-g', '--graph', help="Path and name of output PDF file containing stats graph (.html and .svg extensions write HTML and SVG instead)")
     argument_parser.add_argument('-t', '--target', help="A target domain name or IP address (required if --test is absent)")
     argument_parser.add_argument('--test', help='''Directory containing num_pings text files, each of which contains the output of a ping run. 
     If present, this will override all other options and traceroute will not be invoked. Stats will be computed over the ping output stored in the text files''')
@@ -1,233 +1,391 @@
+import asyncio
+import functools
 import json
 import os
+import pathlib
+import re
+import shlex
+import shutil
 import subprocess
 import argparse
+import array
 import sys
-import time
-import statistics
-from collections import defaultdict
-from typing import List
-import plotly.graph_objs as pogo
-
-
-class TracerouteOutput:
-    def __init__(self, avg, hop, hosts, maximum, median, minimum):
-        self.avg = avg
-        self.hop = hop
-        self.hosts = hosts
-        self.maximum = maximum
-        self.median = median
-        self.minimum = minimum
-
-
-def get_statistics_per_hop(cumulative_data: List[List[TracerouteOutput]]) -> List[dict]:
-    hop_data = {}
-
-    # Grouping data by hop number
-    for run in cumulative_data:
-        for result in run:
-            hop = result.hop
-            if hop not in hop_data:
-                hop_data[hop] = {
-                    'avg': [],
-                    'max': [],
-                    'med': [],
-                    'min': [],
-                    'hosts': []  # Assuming hosts remain consistent per hop
-                }
-            if result.avg:
-                hop_data[hop]['avg'].append(result.avg)
-                hop_data[hop]['max'].append(result.maximum)
-                hop_data[hop]['med'].append(result.median)
-                hop_data[hop]['min'].append(result.minimum)
-                hop_data[hop]['hosts'].append(result.hosts)
-
-    # Calculate statistics for each hop
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+
+# orjson is optional, the standard library serializer is used when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Parsed traceroute outputs keyed by their text, so re-processing the same --test corpus in one process skips parsing
+PARSED_OUTPUT_CACHE = OrderedDict()
+PARSED_OUTPUT_CACHE_SIZE = 256
+
+# Matches either a probe latency "<time> ms" (with "ms" as a whole token) or a host followed by its IP "<name> (<ip>)"
+TRACEROUTE_PROBE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s+ms(?!\S)|([^\s()]+)\s+(\([^)]+\))')
+
+
+# Stats of a single hop in a single traceroute run, hosts and times are tuples so parsed outputs can be cached
+class TracerouteOutput(NamedTuple):
+    avg: Optional[float]
+    hop: str
+    hosts: Tuple[Tuple[str, str], ...]
+    maximum: Optional[float]
+    median: Optional[float]
+    minimum: Optional[float]
+    times: Tuple[float, ...]
+
+
+# Per-hop accumulator filled while parsing, holding one value per run that reached the hop
+def empty_hop_entry():
+    return {
+        'avg': [],
+        'max': [],
+        'med': [],
+        'min': [],
+        'hosts': []  # Assuming hosts remain consistent per hop
+    }
+
+
+# Growable buffer of every probe latency of a hop, stored as packed doubles instead of Python floats
+def empty_latencies():
+    return array.array('d')
+
+
+def get_statistics_per_hop(hop_data) -> List[dict]:
+    # Calculate statistics for each hop in one vectorized pass over a (hops x runs) matrix per statistic.
+    # Hops missing from some runs are padded with NaN, hops without any response get None
+    hops = list(hop_data)
+    responding_hops = [hop for hop in hops if hop_data[hop]['avg']]
+    hop_stats_by_key = {}
+
+    if responding_hops:
+        max_runs = max(len(hop_data[hop]['avg']) for hop in responding_hops)
+        matrices = {key: np.full((len(responding_hops), max_runs), np.nan) for key in ('avg', 'max', 'med', 'min')}
+
+        for row, hop in enumerate(responding_hops):
+            for key, matrix in matrices.items():
+                values = hop_data[hop][key]
+                matrix[row, :len(values)] = values
+
+        averages = np.round(np.nanmean(matrices['avg'], axis=1), 3).tolist()
+        maximums = np.round(np.nanmax(matrices['max'], axis=1), 3).tolist()
+        medians = np.round(np.nanmedian(matrices['med'], axis=1), 3).tolist()
+        minimums = np.round(np.nanmin(matrices['min'], axis=1), 3).tolist()
+
+        for row, hop in enumerate(responding_hops):
+            hop_stats_by_key[hop] = (averages[row], maximums[row], medians[row], minimums[row])
+
+    # Sort the result by hop number
     stats_by_hop = []
 
-    for hop, data in hop_data.items():
-        hop_stats = {
-            'avg': round(statistics.mean(data['avg']),3) if data['avg'] else None,
+    for index in np.argsort(np.array(hops, dtype=np.int32), kind='stable'):
+        hop = hops[index]
+        avg, maximum, median, minimum = hop_stats_by_key.get(hop, (None, None, None, None))
+        stats_by_hop.append({
+            'avg': avg,
             'hop': hop,
-            'hosts': data['hosts'],
-            'max': round(max(data['max']), 3) if data['max'] else None,
-            'med': round(statistics.median(data['med']), 3) if data['med'] else None,
-            'min': round(min(data['min']), 3) if data['min'] else None
-        }
-
-        stats_by_hop.append(hop_stats)
-
-    # Sort the result by hop number
-    stats_by_hop.sort(key=lambda x: int(x['hop']))
+            'hosts': hop_data[hop]['hosts'],
+            'max': maximum,
+            'med': median,
+            'min': minimum
+        })
 
     return stats_by_hop
 
 
 #  Saves the output as a JSON file
 def save_cumulative_stats_json(output, path):
-    with open(path, "w") as json_write:
-        json.dump(output, json_write, indent=4)
+    if orjson:
+        with open(path, "wb") as json_write:
+            json_write.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
+        return
+
+    # Same 2 space indent and raw UTF-8 as orjson, so both paths write identical files
+    with open(path, "w", encoding="utf-8") as json_write:
+        json.dump(output, json_write, indent=2, ensure_ascii=False)
+
+
+# Writes the figure in the format given by the extension of path, HTML is serialized directly without starting Kaleido
+def write_figure(fig, path):
+    suffix = pathlib.Path(path).suffix.lower()
+    if suffix in ('.html', '.htm'):
+        fig.write_html(path, include_plotlyjs='cdn')
+    elif suffix == '.svg':
+        fig.write_image(path, format='svg')
+    else:
+        fig.write_image(path, format='pdf')
 
 
-# Save the output as box plots (latency distribution per each hop) in PDF
+# Save the output as box plots (latency distribution per each hop) in the format given by the -g extension (PDF by default)
 def save_latency_distribution_boxplot_pdf(hop_data, args):
-    hop_data = {k: hop_data[k] for k in sorted(hop_data, key=lambda x: int(x))}
+    # Plotly is only imported once a graph is written, so importing this module (e.g. in the --test worker processes) stays fast
+    import plotly.graph_objs as pogo
+
+    hop_numbers, hop_latencies = zip(*sorted(hop_data.items(), key=lambda item: int(item[0])))
+
+    # A single Box trace grouped by hop label renders all hops at once instead of a trace per hop
+    hop_labels = np.repeat([f"Hop {hop_number}" for hop_number in hop_numbers], [len(latencies) for latencies in hop_latencies])
+    latencies = np.concatenate(hop_latencies)
 
     fig = pogo.Figure()
 
-    for hop_number, latencies in hop_data.items():
-        fig.add_trace(pogo.Box(
-            y=latencies,
-            name=f"Hop {hop_number}",
-            boxpoints='all',  # Show all data points
-            jitter=0.5,  # Spread them out so they don't overlap
-            pointpos=-1.8  # Position of points on the box plot
-        ))
+    fig.add_trace(pogo.Box(
+        x=hop_labels,
+        y=latencies,
+        name="Latencies",
+        boxpoints='all',  # Show all data points
+        jitter=0.5,  # Spread them out so they don't overlap
+        pointpos=-1.8  # Position of points on the box plot
+    ))
 
     fig.update_layout(
         title="Latency Distribution per Hop " + (f"for Domain: {args.target}" if args.target else ""),
         xaxis_title="Hop",
         yaxis_title="Latency (ms)",
-        showlegend=True
+        showlegend=False
     )
 
-    fig.write_image(args.graph if args.graph else "./trstats.pdf", format='pdf')
+    write_figure(fig, args.graph if args.graph else "./trstats.pdf")
 
 
-# Parses the output from traceroute subroutine and returns a list of TracerouteOutput object
-def parse_traceroute_output(traceroute_data, latencies_per_hop) -> List[TracerouteOutput]:
-    hops = traceroute_data.splitlines()[1:] # Skips the traceroute header
-    parsed_output = []
+# Collects probe latencies ("<time> ms") and hosts ("<name> (<ip>)") of the probes of a hop line in one regex scan
+def parse_probe_tokens(probes):
+    times = []
+    hosts = []
 
-    for hop in hops:
-        parts = hop.split()
-        hop_number = parts[0]
+    for latency, host, ip in TRACEROUTE_PROBE_PATTERN.findall(probes):
+        #  This is latency
+        if latency:
+            times.append(float(latency))
+        # This is an IP
+        else:
+            hosts.append([host, ip])
 
-        if parts[1:4] == ["*"] * 3:
-            parsed_output.append(TracerouteOutput(avg=None, hop=hop_number, hosts=[], maximum=None, median=None, minimum=None))
-            continue
+    return times, hosts
+
+
+# Parses a single hop line of traceroute output into a TracerouteOutput
+# Returns None for lines without any latency that are not a timed out hop
+def parse_hop_line(hop) -> Optional[TracerouteOutput]:
+    parts = hop.split(None, 4)
+    hop_number = parts[0]
 
-        times = []
-        hosts = []
+    if parts[1:4] == ["*"] * 3:
+        return TracerouteOutput(avg=None, hop=hop_number, hosts=(), maximum=None, median=None, minimum=None, times=())
 
-        for i in range(1, len(parts)):
-            part = parts[i]
-            # This is an IP
-            if '(' in part and ')' in part:
-                host = parts[i - 1]
-                hosts.append([host, part])
-            #  This is latency
-            elif 'ms' in part:
-                try:
-                    times.append(float(parts[i-1]))
-                except ValueError:
-                    continue
+    # Only the text after the hop number is scanned, so the hop number is never read as a latency
+    times, hosts = parse_probe_tokens(hop.lstrip()[len(hop_number):])
+
+    # Stats over three probes
+    if not times:
+        return None
 
-        # Stats over three probes
-        if times:
-            avg = round(sum(times) / len(times), 2)
-            maximum = max(times)
-            minimum = max(times)
-            median = statistics.median(times)
+    avg = round(sum(times) / len(times), 2)
+    maximum = max(times)
+    minimum = min(times)
+    sorted_times = sorted(times)
+    middle = len(sorted_times) // 2
+    median = sorted_times[middle] if len(sorted_times) % 2 else (sorted_times[middle - 1] + sorted_times[middle]) / 2
 
-            # Creates list of every latency per hop
-            latencies_per_hop[hop_number] = latencies_per_hop.get(hop_number, []) + times
+    return TracerouteOutput(avg=avg, hop=hop_number, hosts=tuple(map(tuple, hosts)), maximum=maximum, median=median, minimum=minimum, times=tuple(times))
 
-            parsed_output.append(TracerouteOutput(avg=avg, hop=hop_number, hosts=hosts, maximum=maximum, median=median, minimum=minimum))
 
-    return parsed_output
+# Groups the stats of a parsed hop into hop_data
+def add_traceroute_output(result: TracerouteOutput, hop_data, latencies_per_hop):
+    hop = result.hop
 
+    # Timed out hops are registered so they are still reported, with no stats
+    hop_entry = hop_data[hop]
+    if not result.times:
+        return
 
-#  Executes the subroutine for traceroute
-def execute_traceroute_subroutine(target, max_hops=None):
-    command = ['traceroute', target, '-m', str(max_hops)] if max_hops else ['traceroute', target]
+    # Creates list of every latency per hop
+    latencies_per_hop[hop].extend(result.times)
+
+    if result.avg:
+        hop_entry['avg'].append(result.avg)
+        hop_entry['max'].append(result.maximum)
+        hop_entry['med'].append(result.median)
+        hop_entry['min'].append(result.minimum)
+        hop_entry['hosts'].append(result.hosts)
+
+
+# Parses a whole traceroute output into a tuple of TracerouteOutput (runs inside a worker process)
+def parse_traceroute_text(traceroute_data) -> Tuple[TracerouteOutput, ...]:
+    hops = traceroute_data.splitlines()[1:] # Skips the traceroute header
+    return tuple(result for result in map(parse_hop_line, hops) if result)
+
+
+# Resolves a command to its absolute path once, falling back to the bare name so a missing command still fails on launch
+@functools.lru_cache(maxsize=None)
+def resolve_command(name):
+    return shutil.which(name) or name
+
+
+#  Executes the subroutine for traceroute, parsing every hop as soon as it is printed
+async def execute_traceroute_subroutine(target, max_hops=None):
+    traceroute = resolve_command('traceroute')
+    command = [traceroute, target, '-m', str(max_hops)] if max_hops else [traceroute, target]
+    parsed_output = []
 
     try:
         '''
-        capture_output=True catches either result (output: stdout or error: stderr)
-        check=True raises a CalledProcessError if subsystem exit code was non-zero (indicates an error)
-        text=True returns output as string instead of bytes
+        stdout=PIPE streams the output line by line while traceroute is still running
+        stderr=PIPE catches the error output, which is only read once stdout is exhausted
+        close_fds=False with an absolute executable path lets subprocess start traceroute with posix_spawn instead of fork + exec
+        A CalledProcessError is raised if subsystem exit code was non-zero (indicates an error)
         '''
-        traceroute_output = subprocess.run(command, capture_output=True, text=True, check=True)
-        return traceroute_output.stdout
+        process = await asyncio.create_subprocess_exec(*command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=False)
+        await process.stdout.readline() # Skips the traceroute header
+        async for hop in process.stdout:
+            result = parse_hop_line(hop.decode())
+            if result:
+                parsed_output.append(result)
+
+        stderr = await process.stderr.read()
+        if await process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, None, stderr)
+        return parsed_output
     except subprocess.CalledProcessError as e:
         print(f"Error executing traceroute {e}", file=sys.stderr)
         return None
 
 
+# Launches every traceroute run concurrently, staggering their start by run_delay seconds
+async def execute_traceroute_runs(args):
+    async def run_once(i):
+        await asyncio.sleep(i * args.run_delay)
+        print(f"Running traceroute {i + 1} of {args.num_runs}")
+        return await execute_traceroute_subroutine(args.target, args.max_hops)
+
+    return await asyncio.gather(*[run_once(i) for i in range(args.num_runs)])
+
+
 def execute_traceroute(args):
-    cumulative_data = []
-    latencies_per_hop = defaultdict(list)
+    hop_data = defaultdict(empty_hop_entry)
+    latencies_per_hop = defaultdict(empty_latencies)
 
-    # Run traceroute NUM_RUNS times
-    for i in range(args.num_runs):
-        print(f"Running traceroute {i + 1} of {args.num_runs}")
-        traceroute_data = execute_traceroute_subroutine(args.target, args.max_hops)
+    # Run traceroute NUM_RUNS times, runs are merged back in run order
+    for parsed_output in asyncio.run(execute_traceroute_runs(args)):
+        for result in parsed_output or ():
+            add_traceroute_output(result, hop_data, latencies_per_hop)
 
-        if traceroute_data:
-            parsed_output = parse_traceroute_output(traceroute_data, latencies_per_hop)
-            cumulative_data.append(parsed_output)
+    return hop_data, latencies_per_hop
 
-        # Introduce a delay except the last run
-        if i < (args.num_runs - 1):
-            time.sleep(args.run_delay)
 
-    return cumulative_data, latencies_per_hop
+# Stores a parsed output in the parent process cache, evicting the least recently used output once it is full
+def cache_parsed_output(traceroute_data, parsed_output):
+    PARSED_OUTPUT_CACHE[traceroute_data] = parsed_output
+    PARSED_OUTPUT_CACHE.move_to_end(traceroute_data)
+    if len(PARSED_OUTPUT_CACHE) > PARSED_OUTPUT_CACHE_SIZE:
+        PARSED_OUTPUT_CACHE.popitem(last=False)
 
 
 def use_test_directory(path):
-    cumulative_data = []
-    latencies_per_hop = defaultdict(list)
+    hop_data = defaultdict(empty_hop_entry)
+    latencies_per_hop = defaultdict(empty_latencies)
+    traceroute_outputs = []
     for filename in os.listdir(path):
-        filepath = os.path.join(path, filename)
-        with open(filepath, 'r') as file:
-            parsed_output = parse_traceroute_output(file.read(), latencies_per_hop)
-            cumulative_data.append(parsed_output)
+        with open(os.path.join(path, filename), 'r') as file:
+            traceroute_outputs.append(file.read())
+
+    # Outputs already parsed by this process are reused, only the new ones are parsed in parallel
+    parsed_outputs = {}
+    for traceroute_data in traceroute_outputs:
+        if traceroute_data in PARSED_OUTPUT_CACHE:
+            parsed_outputs[traceroute_data] = PARSED_OUTPUT_CACHE[traceroute_data]
+    missing_outputs = [traceroute_data for traceroute_data in dict.fromkeys(traceroute_outputs) if traceroute_data not in parsed_outputs]
+
+    if missing_outputs:
+        # Never forks more workers than there are outputs to parse
+        max_workers = min(len(missing_outputs), os.cpu_count() or 1)
+        chunksize = max(1, len(missing_outputs) // (4 * max_workers))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            parsed_outputs.update(zip(missing_outputs, executor.map(parse_traceroute_text, missing_outputs, chunksize=chunksize)))
 
-    return cumulative_data, latencies_per_hop
+    # Every file is merged back in listing order
+    for traceroute_data in traceroute_outputs:
+        parsed_output = parsed_outputs[traceroute_data]
+        cache_parsed_output(traceroute_data, parsed_output)
+        for result in parsed_output:
+            add_traceroute_output(result, hop_data, latencies_per_hop)
 
+    return hop_data, latencies_per_hop
 
-def unwrap_arguments(argument_parser):
-    args = argument_parser.parse_args()
+
+def unwrap_arguments(argument_parser, argv=None):
+    args = argument_parser.parse_args(argv)
 
     stats_per_hop = []
     latencies_per_hop = {}
+    written_paths = []
 
     if args.test:
-        cumulative_data, latencies_per_hop = use_test_directory(args.test)
-        stats_per_hop = get_statistics_per_hop(cumulative_data)
+        hop_data, latencies_per_hop = use_test_directory(args.test)
+        stats_per_hop = get_statistics_per_hop(hop_data)
     else:
         if not args.target:
             argument_parser.error("A target '-t' is required if '--test' is absent)")
 
-        cumulative_data, latencies_per_hop = execute_traceroute(args)
-        stats_per_hop = get_statistics_per_hop(cumulative_data)
+        hop_data, latencies_per_hop = execute_traceroute(args)
+        stats_per_hop = get_statistics_per_hop(hop_data)
 
     if stats_per_hop:
         save_cumulative_stats_json(stats_per_hop, args.output if args.output else "./trstats.json")
+        written_paths.append(args.output if args.output else "./trstats.json")
 
     if latencies_per_hop:
         save_latency_distribution_boxplot_pdf(latencies_per_hop, args)
+        written_paths.append(args.graph if args.graph else "./trstats.pdf")
+
+    return written_paths
 
 
 '''
 Program Execution begins in the main function. It parses arguments that are based from the CLI. If --test is specified, it skips every other flag and tests for existing output.
 Otherwise based on the flags, it either
+With TRSTATS_DAEMON=1 the program keeps running and reads one job per stdin line, written with the same flags as the CLI (e.g. --test runs -g runs.pdf).
+Every graph is rendered in the same process, so the Kaleido renderer is started once and reused across jobs.
+A job that fails is reported and skipped, and every job ends with a "Finished job" or "Failed job" line on stdout
 '''
 def main():
     argument_parser = argparse.ArgumentParser(description='''Welcome to TraceWrap.
     This Program acts as a wrapper for traceroute, a command line tool that automatically executes traceroute multiple times towards a target domain name or IP address''')
     argument_parser.add_argument('-n', '--num-runs', type=int, default=1, help="Number of times traceroute will run")
     argument_parser.add_argument('-d', '--run-delay', type=int, default=0,
-                        help="Number of seconds to wait between two consecutive runs")
+                        help="Number of seconds between the starts of two consecutive runs (runs run concurrently and may overlap)")
     argument_parser.add_argument('-m', '--max-hops', type=int, help="Number of max hops per traceroute run")
     argument_parser.add_argument('-o', '--output', help="Path and name of output JSON file containing the stats")
-    argument_parser.add_argument('-g', '--graph', help="Path and name of output PDF file containing stats graph")
+    argument_parser.add_argument('-g', '--graph', help="Path and name of output PDF file containing stats graph (.html and .svg extensions write HTML and SVG instead)")
     argument_parser.add_argument('-t', '--target', help="A target domain name or IP address (required if --test is absent)")
     argument_parser.add_argument('--test', help='''Directory containing num_runs text files, each of which contains the output of a traceroute run. 
     If present, this will override all other options and traceroute will not be invoked. Stats will be computed over the traceroute output stored in the text files''')
 
-    unwrap_arguments(argument_parser)
+    if os.environ.get('TRSTATS_DAEMON') != '1':
+        unwrap_arguments(argument_parser)
+        return
+
+    # Every job ends with a "Finished" or "Failed" line on stdout, so the process feeding stdin knows when it is done
+    for job in sys.stdin:
+        job = job.strip()
+        if not job:
+            continue
+        try:
+            written_paths = unwrap_arguments(argument_parser, shlex.split(job))
+        except SystemExit:
+            # Invalid flags (or --help) only end the job, not the daemon
+            print(f"Failed job {job}", flush=True)
+            continue
+        except Exception as e:
+            print(f"Error executing job {job} {e}", file=sys.stderr)
+            print(f"Failed job {job}", flush=True)
+            continue
+        print(f"Finished job {job}: {' '.join(written_paths)}", flush=True)
 
 
 if __name__ == '__main__':